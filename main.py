@@ -1,16 +1,55 @@
+import contextlib
+import functools
+import math
 import signal
 import subprocess
 import time
-from typing import Dict, Tuple, TypeAlias
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Tuple, TypeAlias
 
 import modal
 import requests
 from payments_py import Environment, Payments
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 Headers: TypeAlias = Dict[str, str]
 
 
+def make_pooled_session() -> requests.Session:
+    """
+    A session that keeps connections alive across calls, so repeated requests
+    to the same host skip the TCP and TLS handshakes.
+
+    Only failures to connect are retried. A request that may have reached the
+    server is never resent, as a paid call could then be charged twice.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, read=0, status=0, other=0, backoff_factor=0.1),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+http_session = make_pooled_session()
+
+
+def _ok_json(response: requests.Response) -> Any:
+    """
+    Raise if the response is an error, otherwise return its parsed JSON body.
+    """
+    response.raise_for_status()
+    return response.json()
+
+
+# subscription_did -> service_did
+_service_did_cache: Dict[str, str] = {}
+
+
 def get_subscription_balance(
     payments: Payments,
     account_address: str,
@@ -20,17 +59,51 @@ def get_subscription_balance(
         subscription_did=subscription_did,
         account_address=account_address,
     )
-    response.raise_for_status()
-    return int(response.json()["balance"])
+    return int(_ok_json(response)["balance"])
+
+
+def wait_for_balance_change(
+    payments: Payments,
+    account_address: str,
+    subscription_did: str,
+    prev_balance: int,
+    min_change: int = 1,
+    timeout: float = 15.0,
+    interval: float = 0.25,
+) -> int:
+    """
+    Poll the subscription balance until it differs from `prev_balance` by at
+    least `min_change`, and return the new balance.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        balance = get_subscription_balance(
+            payments=payments,
+            account_address=account_address,
+            subscription_did=subscription_did,
+        )
+        if abs(balance - prev_balance) >= min_change:
+            return balance
+        time.sleep(interval)
+    raise TimeoutError(
+        f"Balance did not change from {prev_balance} after {timeout} seconds"
+    )
 
 
 def service_did_from_subscription(payments: Payments, subscription_did: str) -> str:
+    """
+    Get the DID of the single service associated with a subscription. This
+    cannot change, so it is only fetched once per subscription.
+    """
+    if subscription_did in _service_did_cache:
+        return _service_did_cache[subscription_did]
+
     response = payments.get_subscription_associated_services(subscription_did)
-    response.raise_for_status()
-    response_json = response.json()
+    response_json = _ok_json(response)
     if len(response_json) != 1:
         raise ValueError(f"Expected 1 service, got {len(response_json)}")
-    return response.json()[0]
+    _service_did_cache[subscription_did] = response_json[0]
+    return response_json[0]
 
 
 def get_endpoint_and_headers(
@@ -38,8 +111,7 @@ def get_endpoint_and_headers(
     service_did: str,
 ) -> Tuple[str, Headers]:
     service_token_response = payments.get_service_token(service_did)
-    service_token_response.raise_for_status()
-    response_json = service_token_response.json()
+    response_json = _ok_json(service_token_response)
     jwt_token = response_json["token"]["accessToken"]
     headers = {
         "Authorization": f"Bearer {jwt_token}",
@@ -67,149 +139,229 @@ class EphemeralModalServer:
     a `if __name__ == "__main__":` block, using `python script.py`.
     """
 
-    def __init__(self, app: modal.App, script_name: str):
+    def __init__(self, app: modal.App, script_name: str, timeout: float = 60.0):
         self.script_name: str = script_name
+        self.timeout: float = timeout
         self.process: subprocess.Popen | None = None
+
+        # Retry failed connects at the adapter level, so the readiness loop in
+        # `__enter__` only sees responses and read errors.
+        self.session: requests.Session = requests.Session()
+        retry = Retry(total=2, read=0, status=0, other=0, backoff_factor=0.05)
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.head_supported: bool = True
         if len(app.registered_web_endpoints) != 1:
             raise ValueError("App must have exactly one registered web endpoint")
-        self.url = f"https://{self.get_modal_user_name()}--{app.name}-{app.registered_web_endpoints[0]}-dev.modal.run"
+        endpoint = app.registered_web_endpoints[0]
+
+        # Modal replaces underscores with hyphens in the hostname, and
+        # truncates (with a hash suffix) any label longer than a DNS label
+        # allows, which we can't reproduce here.
+        label = f"{self.get_modal_user_name()}--{app.name}-{endpoint}-dev"
+        label = label.replace("_", "-").lower()
+        if len(label) > 63:
+            raise ValueError(
+                f"Modal URL label {label!r} is longer than 63 characters, so "
+                "Modal will truncate it. Use a shorter app or function name."
+            )
+        self.url = f"https://{label}.modal.run"
+        self.openapi_url = f"{self.url}/openapi.json"
+
+    def probe(self) -> int:
+        """
+        Probe the server with a HEAD request, falling back to a GET whose body
+        is never read if the server does not allow HEAD. Returns the status
+        code.
+        """
+        if self.head_supported:
+            response = self.session.head(
+                self.openapi_url, allow_redirects=True, timeout=0.5
+            )
+            if response.status_code != 405:
+                return response.status_code
+            self.head_supported = False
 
-    @property
-    def openapi_url(self) -> str:
-        return f"{self.url}/openapi.json"
+        response = self.session.get(self.openapi_url, stream=True, timeout=0.5)
+        response.close()
+        return response.status_code
 
     def __enter__(self):
-        # Start the server
+        # Start the server. Its output is never read, so discard it rather
+        # than letting a full pipe buffer block the process.
         self.process = subprocess.Popen(
             ["modal", "serve", self.script_name],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
         )
 
-        # Wait for the URL to be accessible
-        max_retries = 5
-        tries = 0
-        while True:
+        # Wait for the URL to be accessible, backing off exponentially
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        last_result = "no response"
+        while time.monotonic() < deadline:
             try:
-                response = requests.get(self.url)
-                if response.status_code == 200:
+                status_code = self.probe()
+                if status_code < 400:
                     break
-            except requests.exceptions.RequestException:
-                pass
-            time.sleep(1)
-            tries += 1
-            if tries >= max_retries:
-                raise TimeoutError(
-                    f"Could not connect to {self.url} after {max_retries} retries"
-                )
+                last_result = f"status {status_code}"
+            except requests.exceptions.RequestException as e:
+                last_result = repr(e)
+            time.sleep(min(0.5, 0.05 * 2**attempt))
+            attempt += 1
+        else:
+            self.__exit__(None, None, None)
+            raise TimeoutError(
+                f"{self.url} was not ready after {self.timeout} seconds "
+                f"(last result: {last_result})"
+            )
 
         return self
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def get_modal_user_name() -> str:
-        return (
-            subprocess.run(
-                "modal profile current",
-                shell=True,
-                capture_output=True,
-                check=True,
-            )
-            .stdout.decode()
-            .strip()
-        )
+        return subprocess.run(
+            ["modal", "profile", "current"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
 
     def __exit__(self, exc_type, exc_value, traceback):
         # Send Ctrl+C to the process
         if self.process:
             self.process.send_signal(signal.SIGINT)
             self.process.wait()
+        self.session.close()
 
 
 if __name__ == "__main__":
     ###
-    ### 0. Define some endpoint to paywall with Nevermined, import here, and
-    ###    start the server
+    ### 0. Define some endpoint to paywall with Nevermined, and import here
     ###
     from my_endpoint import BASIC_SERVICE_CHARGE, PREMIUM_SERVICE_CHARGE, app
 
     FLAT_SERVICE_CHARGE = 2
+    CREDITS_PER_ORDER = 100
+    MAX_CONCURRENT_ORDERS = 8
     app_definition_path = "./my_endpoint.py"
 
-    print("Starting server...")
-    with EphemeralModalServer(app=app, script_name=app_definition_path) as modal_server:
-        ###
-        ### 1. Create a subscription and service for the endpoint
-        ###
-        nevermined_settings = NeverminedSettings()
-        creator_payments = Payments(
-            nvm_api_key=nevermined_settings.CREATOR_API_KEY,
-            environment=Environment.appTesting,
-        )
+    ###
+    ### 1. Start the server, and create a subscription and service for the
+    ###    endpoint
+    ###
+    nevermined_settings = NeverminedSettings()
+    creator_payments = Payments(
+        nvm_api_key=nevermined_settings.CREATOR_API_KEY,
+        environment=Environment.appTesting,
+    )
 
-        # Create subscription
+    with contextlib.ExitStack() as stack:
+        # Create subscription. It doesn't depend on the server, so do it in the
+        # background while the server starts up.
         print("Creating subscription...")
-        subscription_response = creator_payments.create_subscription(
+        subscription_executor = stack.enter_context(
+            ThreadPoolExecutor(max_workers=1)
+        )
+        subscription_future = subscription_executor.submit(
+            creator_payments.create_subscription,
             name="Test",
             description="A test subscription",
             price=10000,  # 0.01 USDC
             token_address="0x75faf114eafb1BDbe2F0316DF893fd58CE46AA4d",  # USDC
-            amount_of_credits=100,
+            amount_of_credits=CREDITS_PER_ORDER,
             duration=100000,  # TODO how to make 'forever'?
             tags=[],
         )
-        subscription_response.raise_for_status()
-        subscription_did = subscription_response.json()["did"]
 
-        # Create service
+        print("Starting server...")
+        try:
+            modal_server = stack.enter_context(
+                EphemeralModalServer(app=app, script_name=app_definition_path)
+            )
+        finally:
+            # Collect the subscription even if the server fails to start, so
+            # any error creating it is raised rather than lost
+            subscription_response = subscription_future.result()
+        subscription_did = _ok_json(subscription_response)["did"]
+
+        # Create service, and set up the consumer client while we wait
         print("Creating service...")
-        service_response = creator_payments.create_service(
-            subscription_did=subscription_did,
-            name="Test",
-            description="A test service",
-            service_charge_type="dynamic",
-            auth_type="none",
-            endpoints=[{"get": modal_server.url}],
-            open_api_url=modal_server.openapi_url,
-            min_credits_to_charge=BASIC_SERVICE_CHARGE,
-            max_credits_to_charge=PREMIUM_SERVICE_CHARGE,
-            amount_of_credits=0,  # Placeholder, unused TODO
-        )
-        service_response.raise_for_status()
-
-        ###
-        ### 2. As a consumer, pay for the subscription and test the service
-        ###
-        consumer_payments = Payments(
-            nvm_api_key=nevermined_settings.CONSUMER_API_KEY,
-            environment=Environment.appTesting,
-        )
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            service_future = executor.submit(
+                creator_payments.create_service,
+                subscription_did=subscription_did,
+                name="Test",
+                description="A test service",
+                service_charge_type="dynamic",
+                auth_type="none",
+                endpoints=[{"get": modal_server.url}],
+                open_api_url=modal_server.openapi_url,
+                min_credits_to_charge=BASIC_SERVICE_CHARGE,
+                max_credits_to_charge=PREMIUM_SERVICE_CHARGE,
+                amount_of_credits=0,  # Placeholder, unused TODO
+            )
 
-        # Top up if required
-        init_balance = get_subscription_balance(
-            payments=consumer_payments,
-            account_address=nevermined_settings.CONSUMER_ADDRESS,
-            subscription_did=subscription_did,
-        )
+            # Consumer client
+            consumer_payments = Payments(
+                nvm_api_key=nevermined_settings.CONSUMER_API_KEY,
+                environment=Environment.appTesting,
+            )
 
-        # So we can run all modes of the service
-        MIN_CREDIT_BALANCE = BASIC_SERVICE_CHARGE + PREMIUM_SERVICE_CHARGE
+            ###
+            ### 2. As a consumer, pay for the subscription and test the service
+            ###
 
-        balance = init_balance
-        while balance < MIN_CREDIT_BALANCE:
-            print("Topping up...")
-            order_response = consumer_payments.order_subscription(
-                subscription_did=subscription_did
-            )
-            order_response.raise_for_status()
-            new_balance = get_subscription_balance(
+            # Top up if required, so we can run all modes of the service
+            MIN_CREDIT_BALANCE = BASIC_SERVICE_CHARGE + PREMIUM_SERVICE_CHARGE
+
+            init_balance = get_subscription_balance(
                 payments=consumer_payments,
                 account_address=nevermined_settings.CONSUMER_ADDRESS,
                 subscription_did=subscription_did,
             )
-            assert new_balance > init_balance
-            balance = new_balance
 
-        service_did = service_did_from_subscription(consumer_payments, subscription_did)
+            # Don't pay for the subscription unless its service was created.
+            # Then look up the service DID in the background while topping up.
+            service_future.result().raise_for_status()
+            service_did_future = executor.submit(
+                service_did_from_subscription, consumer_payments, subscription_did
+            )
+
+            balance = init_balance
+            deficit = MIN_CREDIT_BALANCE - init_balance
+            if deficit > 0:
+                num_orders = math.ceil(deficit / CREDITS_PER_ORDER)
+                print(f"Topping up with {num_orders} order(s)...")
+                with ThreadPoolExecutor(
+                    max_workers=min(num_orders, MAX_CONCURRENT_ORDERS)
+                ) as order_executor:
+                    order_responses = list(
+                        order_executor.map(
+                            lambda _: consumer_payments.order_subscription(
+                                subscription_did=subscription_did
+                            ),
+                            range(num_orders),
+                        )
+                    )
+                for order_response in order_responses:
+                    order_response.raise_for_status()
+
+                # Verify once that all the ordered credits have landed
+                top_up = num_orders * CREDITS_PER_ORDER
+                balance = wait_for_balance_change(
+                    payments=consumer_payments,
+                    account_address=nevermined_settings.CONSUMER_ADDRESS,
+                    subscription_did=subscription_did,
+                    prev_balance=init_balance,
+                    min_change=top_up,
+                )
+                assert balance == init_balance + top_up
+
+            service_did = service_did_future.result()
+
+        # Only request the service token once the consumer holds credits for
+        # the subscription
         endpoint, headers = get_endpoint_and_headers(
             payments=consumer_payments,
             service_did=service_did,
@@ -217,24 +369,32 @@ if __name__ == "__main__":
 
         # Test the service!
         print("Testing service...")
-        for name in ["Foo", None]:
-            response = requests.get(endpoint, headers=headers, params={"name": name})
+        names = ["Foo", None]
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            responses = list(
+                executor.map(
+                    lambda name: http_session.get(
+                        endpoint, headers=headers, params={"name": name}
+                    ),
+                    names,
+                )
+            )
+        for name, response in zip(names, responses):
             response.raise_for_status()
             assert response.text == f"Hello {name if name else 'World'}"
 
-            time.sleep(10)  # Wait for the balance to update. TODO
-            new_balance = get_subscription_balance(
-                payments=consumer_payments,
-                account_address=nevermined_settings.CONSUMER_ADDRESS,
-                subscription_did=subscription_did,
-            )
-
-            # Test the variable service charge feature
-            if name:
-                assert new_balance == balance - PREMIUM_SERVICE_CHARGE
-            else:
-                assert new_balance == balance - BASIC_SERVICE_CHARGE
-
-            balance = new_balance
+        # Test the variable service charge feature
+        expected_charge = sum(
+            PREMIUM_SERVICE_CHARGE if name else BASIC_SERVICE_CHARGE
+            for name in names
+        )
+        new_balance = wait_for_balance_change(
+            payments=consumer_payments,
+            account_address=nevermined_settings.CONSUMER_ADDRESS,
+            subscription_did=subscription_did,
+            prev_balance=balance,
+            min_change=expected_charge,
+        )
+        assert new_balance == balance - expected_charge
 
         print("Service ran successfully!")
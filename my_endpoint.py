@@ -1,19 +1,38 @@
+import functools
+from typing import Dict, Tuple
+
 import modal
 from fastapi import Response
 
-image = modal.Image.debian_slim().pip_install("requests")
+image = modal.Image.debian_slim()
 app = modal.App(name="example", image=image)
 
 BASIC_SERVICE_CHARGE = 1
 PREMIUM_SERVICE_CHARGE = 10
 
 
-@app.function()
-@modal.web_endpoint(docs=True)
-def test(name: str = "World") -> Response:
+def greeting(name: str) -> Tuple[bytes, Dict[str, str]]:
+    """
+    The response body and headers for a given name.
+    """
     credits_consumed = (
         BASIC_SERVICE_CHARGE if name == "World" else PREMIUM_SERVICE_CHARGE
     )
     headers = {"NVMCreditsConsumed": str(credits_consumed)}
-    content = f"Hello {name}"
-    return Response(content=content, headers=headers, media_type="application/json")
+    content = f"Hello {name}".encode("utf-8")
+    return content, headers
+
+
+# Responses are fixed per name, so build the default one up front and
+# memoize the rest. Response only reads the headers, so they can be shared.
+_RESPONSES = {"World": greeting("World")}
+cached_greeting = functools.lru_cache(maxsize=128)(greeting)
+
+
+@app.function()
+@modal.web_endpoint(docs=True)
+def test(name: str = "World") -> Response:
+    content, headers = _RESPONSES.get(name) or cached_greeting(name)
+    return Response(
+        content=content, headers=headers, media_type="text/plain; charset=utf-8"
+    )